@@ -0,0 +1,48 @@
+"""unique index on cart_items (session_id, product_id)
+
+Revision ID: 0002
+Revises: 0001
+Create Date: 2026-10-15 18:20:00.000000
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = '0002'
+down_revision: Union[str, Sequence[str], None] = '0001'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    # التحقق ثم الإضافة القديم عبر أكثر من worker قد يكون أنشأ صفوفاً مكررة لنفس المنتج في نفس الجلسة؛
+    # ندمجها في الصف الأقدم (بجمع الكميات) قبل إنشاء الفهرس الفريد
+    op.execute("""
+        UPDATE cart_items AS c
+        SET quantity = d.total_quantity
+        FROM (
+            SELECT MIN(id) AS keep_id, SUM(quantity) AS total_quantity
+            FROM cart_items
+            GROUP BY session_id, product_id
+            HAVING COUNT(*) > 1
+        ) AS d
+        WHERE c.id = d.keep_id
+    """)
+    op.execute("""
+        DELETE FROM cart_items AS c
+        USING cart_items AS k
+        WHERE c.session_id = k.session_id
+          AND c.product_id = k.product_id
+          AND c.id > k.id
+    """)
+    op.create_index('ix_cart_item_session_product', 'cart_items', ['session_id', 'product_id'], unique=True)
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    op.drop_index('ix_cart_item_session_product', table_name='cart_items')
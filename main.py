@@ -4,63 +4,259 @@
 # ===================================================================
 # 1. Imports + إعدادات بدون .env
 # ===================================================================
-from fastapi import FastAPI, Depends, HTTPException, status, WebSocket, WebSocketDisconnect
+from fastapi import FastAPI, Depends, HTTPException, Query, Response, status, WebSocket, WebSocketDisconnect
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
-from sqlalchemy.orm import Session
-from typing import Dict, List
+from fastapi.concurrency import run_in_threadpool
+from sqlalchemy import delete, lambda_stmt, select, update
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import joinedload
+from typing import Dict, List, Optional, Set
+from contextlib import asynccontextmanager
+import asyncio
+import logging
+import logging.handlers
+import queue
 import models
 import schemas
 import database
 from fastapi.middleware.cors import CORSMiddleware
 import stripe
 from datetime import datetime, timedelta
+from functools import lru_cache
+import time
 import uuid
+from cachetools import TTLCache
 from jose import jwt, JWTError
+import orjson
+import redis.asyncio as aioredis
+from redis.exceptions import RedisError
 import os
 
 # لا نستخدم load_dotenv() أبداً
 ALGORITHM = "HS256"
 ACCESS_TOKEN_EXPIRE_MINUTES = 60
+# كل عامل (worker) يملك نسخته من الـ cache، وتعديل payment_token يُبطل نسخة العامل الحالي فقط،
+# لذا قد ترى بقية العمال البيانات القديمة لمدة تصل إلى هذه القيمة
+USER_CACHE_TTL_SECONDS = 30
+PRODUCTS_CACHE_TTL_SECONDS = 60
+PRODUCTS_PAGE_SIZE = 100
+PRODUCTS_MAX_PAGE_SIZE = 500
 
 # المتغيّرات المطلوبة يجب أن توجد في Environment Variables مباشرةً
 SECRET_KEY = os.getenv("SECRET_KEY")
 stripe.api_key = os.getenv("STRIPE_SECRET_KEY")
 
+# اختياري: بدونه تُرسل تحديثات السلة داخل العامل (worker) الحالي فقط
+REDIS_URL = os.getenv("REDIS_URL")
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
+
 # تحقّق سريع أن القيم موجودة عند الإطلاق
 if not SECRET_KEY or not stripe.api_key:
     raise RuntimeError("Environment variables SECRET_KEY and STRIPE_SECRET_KEY must be set!")
 
+# نرمّز المفتاح مرة واحدة بدلاً من أن تعيد jose ترميزه في كل استدعاء
+SECRET_KEY_BYTES = SECRET_KEY.encode()
+
 
 
-app = FastAPI(title="WalkOut Store API")
+# ===================================================================
+# 2. Logging
+# ===================================================================
+# الكتابة الفعلية إلى stderr تتم في thread منفصل حتى لا تعطّل مسار الطلب
+log_queue: queue.SimpleQueue = queue.SimpleQueue()
+log_handler = logging.StreamHandler()
+log_handler.setFormatter(logging.Formatter("%(asctime)s %(levelname)s [%(name)s] %(message)s"))
+log_listener = logging.handlers.QueueListener(log_queue, log_handler)
+
+logger = logging.getLogger(__name__)
+logger.setLevel(LOG_LEVEL)
+logger.addHandler(logging.handlers.QueueHandler(log_queue))
+logger.propagate = False
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    log_listener.start()
+    await manager.start()
+    yield
+    await manager.stop()
+    log_listener.stop()
+
+app = FastAPI(title="WalkOut Store API", lifespan=lifespan)
 app.add_middleware(
     CORSMiddleware,
     allow_origins=["*"],
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["X-Next-Cursor"],
 )
 # ===================================================================
 # 3. WebSocket Connection Manager
 # ===================================================================
+WS_SHARD_COUNT = 64  # يجب أن يكون من قوى العدد 2
+WS_QUEUE_SIZE = 1000
+CART_CHANNEL_PREFIX = "cart:"
+
+class ClientConnection:
+    def __init__(self, websocket: WebSocket):
+        self.websocket = websocket
+        self.queue: asyncio.Queue = asyncio.Queue(maxsize=WS_QUEUE_SIZE)
+        self.writer: Optional[asyncio.Task] = None
+
 class ConnectionManager:
     def __init__(self):
-        self.active_connections: Dict[int, WebSocket] = {}
+        # الاتصالات موزّعة على عدة أجزاء، لكل جزء قفله الخاص
+        self.shards: List[Dict[int, ClientConnection]] = [{} for _ in range(WS_SHARD_COUNT)]
+        self.locks: List[asyncio.Lock] = [asyncio.Lock() for _ in range(WS_SHARD_COUNT)]
+        # Redis pub/sub يوصل التحديثات إلى العامل الذي يملك الـ WebSocket
+        self.redis: Optional[aioredis.Redis] = None
+        self.pubsub = None
+        self.listener: Optional[asyncio.Task] = None
+        # جلسات فشل اشتراكها في Redis؛ نوصل تحديثاتها محلياً ونعيد محاولة الاشتراك عند كل تحديث
+        self.unsubscribed_sessions: Set[int] = set()
+        # نحتفظ بمراجع مهام الإغلاق حتى لا يجمعها الـ garbage collector قبل انتهائها
+        self.background_tasks: Set[asyncio.Task] = set()
+
+    async def start(self):
+        if REDIS_URL:
+            self.redis = aioredis.from_url(REDIS_URL, decode_responses=True)
+            self.pubsub = self.redis.pubsub(ignore_subscribe_messages=True)
+
+    async def stop(self):
+        if self.listener is not None:
+            self.listener.cancel()
+        if self.pubsub is not None:
+            await self.pubsub.aclose()
+        if self.redis is not None:
+            await self.redis.aclose()
+
+    def _shard(self, session_id: int) -> int:
+        return session_id & (WS_SHARD_COUNT - 1)
 
     async def connect(self, session_id: int, websocket: WebSocket):
         await websocket.accept()
-        self.active_connections[session_id] = websocket
-        print(f"WebSocket connected for session {session_id}")
-
-    def disconnect(self, session_id: int):
-        if session_id in self.active_connections:
-            del self.active_connections[session_id]
-        print(f"WebSocket disconnected for session {session_id}")
+        connection = ClientConnection(websocket)
+        connection.writer = asyncio.create_task(self._writer(session_id, connection))
+        shard = self._shard(session_id)
+        async with self.locks[shard]:
+            previous = self.shards[shard].get(session_id)
+            self.shards[shard][session_id] = connection
+        if previous is not None:
+            previous.writer.cancel()
+            self._close_in_background(previous.websocket, status.WS_1000_NORMAL_CLOSURE, "Replaced by a newer connection")
+        elif self.pubsub is not None:
+            await self._subscribe(session_id)
+        logger.info("WebSocket connected for session %s", session_id)
+
+    async def _subscribe(self, session_id: int):
+        try:
+            await self.pubsub.subscribe(f"{CART_CHANNEL_PREFIX}{session_id}")
+        except RedisError as e:
+            # Redis غير متاح: يبقى الاتصال مسجّلاً ويستقبل التحديثات من هذا العامل فقط
+            logger.warning("Redis subscribe failed for session %s, using local delivery only: %s", session_id, e)
+            self.unsubscribed_sessions.add(session_id)
+            return
+        self.unsubscribed_sessions.discard(session_id)
+        # get_message يتطلب اشتراكاً واحداً على الأقل، لذا نبدأ الاستماع بعد أول اشتراك
+        if self.listener is None:
+            self.listener = asyncio.create_task(self._listen())
+
+    async def disconnect(self, session_id: int, websocket: Optional[WebSocket] = None):
+        shard = self._shard(session_id)
+        async with self.locks[shard]:
+            connection = self.shards[shard].get(session_id)
+            # لا نحذف اتصالاً أحدث حلّ محل الاتصال الذي انقطع
+            if connection is None or (websocket is not None and connection.websocket is not websocket):
+                return
+            del self.shards[shard][session_id]
+        connection.writer.cancel()
+        if session_id in self.unsubscribed_sessions:
+            self.unsubscribed_sessions.discard(session_id)
+        elif self.pubsub is not None:
+            try:
+                await self.pubsub.unsubscribe(f"{CART_CHANNEL_PREFIX}{session_id}")
+            except RedisError as e:
+                logger.warning("Redis unsubscribe failed for session %s: %s", session_id, e)
+        logger.info("WebSocket disconnected for session %s", session_id)
 
     async def send_cart_update(self, session_id: int, cart_data: dict):
-        if session_id in self.active_connections:
-            websocket = self.active_connections[session_id]
-            await websocket.send_json(cart_data)
-            print(f"Sent cart update to session {session_id}")
+        # نرمّز السلة مرة واحدة؛ نفس النص يمر عبر Redis وطوابير الإرسال دون إعادة ترميز
+        # (orjson أسرع من json في Starlette، ونُبقي الإطار نصياً كما يتوقعه العميل)
+        payload = orjson.dumps(cart_data).decode()
+        if self.redis is not None:
+            try:
+                await self.redis.publish(f"{CART_CHANNEL_PREFIX}{session_id}", payload)
+            except RedisError as e:
+                logger.warning("Redis publish failed for session %s: %s", session_id, e)
+            else:
+                if session_id not in self.unsubscribed_sessions:
+                    return
+                # الرسالة المنشورة لن تصل هذه الجلسة عبر Redis، فنرسلها محلياً ثم نعيد محاولة الاشتراك
+                await self._local_send(session_id, payload)
+                # قد يكون الاتصال أُغلق أثناء الإرسال المحلي (طابور ممتلئ)
+                if session_id in self.unsubscribed_sessions:
+                    await self._subscribe(session_id)
+                return
+        await self._local_send(session_id, payload)
+
+    async def _local_send(self, session_id: int, payload: str):
+        shard = self._shard(session_id)
+        async with self.locks[shard]:
+            connection = self.shards[shard].get(session_id)
+        if connection is None:
+            return
+        # لا ننتظر العميل هنا؛ مهمة الكتابة ترسل الرسائل في الخلفية
+        try:
+            connection.queue.put_nowait(payload)
+        except asyncio.QueueFull:
+            logger.warning("WebSocket queue full for session %s, dropping connection", session_id)
+            await self.disconnect(session_id, connection.websocket)
+            self._close_in_background(connection.websocket, status.WS_1013_TRY_AGAIN_LATER, "Too many pending updates")
+
+    def _close_in_background(self, websocket: WebSocket, code: int, reason: str):
+        # الإغلاق ينتظر المصافحة مع العميل، فلا نعطّل الطلب الحالي به
+        task = asyncio.create_task(self._close(websocket, code, reason))
+        self.background_tasks.add(task)
+        task.add_done_callback(self.background_tasks.discard)
+
+    async def _close(self, websocket: WebSocket, code: int, reason: str):
+        try:
+            await websocket.close(code=code, reason=reason)
+        except (WebSocketDisconnect, RuntimeError) as e:
+            logger.debug("Closing WebSocket failed: %s", e)
+
+    async def _writer(self, session_id: int, connection: ClientConnection):
+        try:
+            while True:
+                payload = await connection.queue.get()
+                # كل تحديث لقطة كاملة للسلة، لذا نرسل الأحدث فقط ونتجاهل ما تراكم قبله
+                while True:
+                    try:
+                        payload = connection.queue.get_nowait()
+                    except asyncio.QueueEmpty:
+                        break
+                await connection.websocket.send_text(payload)
+                logger.debug("Sent cart update to session %s", session_id)
+        except (WebSocketDisconnect, RuntimeError):
+            # العميل أغلق الاتصال؛ حلقة الاستقبال في websocket_endpoint تتولى التنظيف
+            pass
+
+    async def _listen(self):
+        while True:
+            try:
+                message = await self.pubsub.get_message(ignore_subscribe_messages=True, timeout=1.0)
+            except RedisError as e:
+                logger.warning("Redis listener error: %s", e)
+                await asyncio.sleep(1)
+                continue
+            if message is None or message["type"] != "message":
+                continue
+            # خطأ في رسالة واحدة يجب ألا يوقف الاستماع لبقية عمر العامل
+            try:
+                session_id = int(message["channel"][len(CART_CHANNEL_PREFIX):])
+                await self._local_send(session_id, message["data"])
+            except Exception:
+                logger.exception("Failed to deliver Redis message on %s", message["channel"])
 
 manager = ConnectionManager()
 
@@ -69,13 +265,31 @@ manager = ConnectionManager()
 # ===================================================================
 bearer_scheme = HTTPBearer()
 
-def create_access_token(data: dict):
-    to_encode = data.copy()
-    expire = datetime.utcnow() + timedelta(minutes=ACCESS_TOKEN_EXPIRE_MINUTES)
-    to_encode.update({"exp": expire})
-    return jwt.encode(to_encode, SECRET_KEY, algorithm=ALGORITHM)
+# user_id -> نسخة ثابتة (UserResponse) من المستخدم لتجنّب استعلام قاعدة البيانات في كل طلب موثَّق؛
+# لا نخزّن كائن ORM لأنه مرتبط بجلسة قاعدة بيانات طلب سابق
+user_cache: TTLCache = TTLCache(maxsize=4096, ttl=USER_CACHE_TTL_SECONDS)
+
+# قائمة المنتجات نادراً ما تتغيّر، فنخزّن كل صفحة (cursor, limit) مُرمَّزة كـ JSON جاهز للإرسال
+products_cache: TTLCache = TTLCache(maxsize=256, ttl=PRODUCTS_CACHE_TTL_SECONDS)
 
-def get_current_user(credentials: HTTPAuthorizationCredentials = Depends(bearer_scheme), db: Session = Depends(database.get_db)):
+def create_access_token(user_id: int) -> str:
+    # exp عدد صحيح بالثواني (unix timestamp) كما في RFC 7519
+    expire = int(time.time()) + ACCESS_TOKEN_EXPIRE_MINUTES * 60
+    return jwt.encode({"user_id": user_id, "exp": expire}, SECRET_KEY_BYTES, algorithm=ALGORITHM)
+
+@lru_cache(maxsize=4096)
+def decode_access_token(token: str) -> dict:
+    return jwt.decode(token, SECRET_KEY_BYTES, algorithms=[ALGORITHM])
+
+def build_cart_response(session_id: int, cart_items: List[models.Cart_Item]) -> schemas.CartResponse:
+    response_items = [
+        schemas.CartItemResponse(product_id=ci.product_id, name=ci.product.name, quantity=ci.quantity, price=ci.price_at_pickup)
+        for ci in cart_items
+    ]
+    current_total = sum(i.quantity * i.price for i in response_items)
+    return schemas.CartResponse(session_id=session_id, items=response_items, current_total=round(current_total, 2))
+
+async def get_current_user(credentials: HTTPAuthorizationCredentials = Depends(bearer_scheme), db: AsyncSession = Depends(database.get_db)):
     token = credentials.credentials
     credentials_exception = HTTPException(
         status_code=status.HTTP_401_UNAUTHORIZED,
@@ -83,16 +297,23 @@ def get_current_user(credentials: HTTPAuthorizationCredentials = Depends(bearer_
         headers={"WWW-Authenticate": "Bearer"},
     )
     try:
-        payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
+        payload = decode_access_token(token)
+        # النتيجة قد تأتي من الـ cache، لذا نتحقق من انتهاء الصلاحية بأنفسنا
+        if payload.get("exp", 0) <= time.time():
+            raise credentials_exception
         user_id: int = payload.get("user_id")
         if user_id is None:
             raise credentials_exception
     except JWTError:
         raise credentials_exception
     
-    user = db.query(models.User).filter(models.User.id == user_id).first()
+    user = user_cache.get(user_id)
     if user is None:
-        raise credentials_exception
+        db_user = await db.get(models.User, user_id)
+        if db_user is None:
+            raise credentials_exception
+        user = schemas.UserResponse.model_validate(db_user)
+        user_cache[user_id] = user
     return user
 
 # ===================================================================
@@ -100,7 +321,7 @@ def get_current_user(credentials: HTTPAuthorizationCredentials = Depends(bearer_
 # ===================================================================
 
 @app.get("/")
-def read_root():
+async def read_root():
     return {"status": "ok", "message": "Welcome to WalkOut Store API!"}
 
 @app.websocket("/ws/cart/{session_id}")
@@ -110,158 +331,226 @@ async def websocket_endpoint(websocket: WebSocket, session_id: int):
         while True:
             await websocket.receive_text()
     except WebSocketDisconnect:
-        manager.disconnect(session_id)
+        await manager.disconnect(session_id, websocket)
 
 @app.post("/auth/register", status_code=status.HTTP_201_CREATED, response_model=schemas.UserResponse)
-def register_user(user: schemas.UserCreate, db: Session = Depends(database.get_db)):
-    existing_user = db.query(models.User).filter(models.User.phone_number == user.phone_number).first()
-    if existing_user:
+async def register_user(user: schemas.UserCreate, db: AsyncSession = Depends(database.get_db)):
+    # ON CONFLICT DO NOTHING يجعل التحقق والإضافة عملية ذرّية واحدة
+    stmt = (
+        insert(models.User)
+        .values(phone_number=user.phone_number)
+        .on_conflict_do_nothing(index_elements=[models.User.phone_number])
+        .returning(models.User)
+    )
+    result = await db.execute(stmt)
+    new_user = result.scalar_one_or_none()
+    if new_user is None:
         raise HTTPException(status_code=status.HTTP_409_CONFLICT, detail="Phone number already registered.")
+    await db.commit()
     
-    new_user = models.User(phone_number=user.phone_number)
-    db.add(new_user)
-    db.commit()
-    db.refresh(new_user)
-    
-    print(f"--- OTP for {user.phone_number} is: 1234 ---")
+    logger.info("--- OTP for %s is: 1234 ---", user.phone_number)
     return new_user
 
 @app.post("/auth/verify", response_model=schemas.Token)
-def verify_user(verification_data: schemas.UserVerify, db: Session = Depends(database.get_db)):
+async def verify_user(verification_data: schemas.UserVerify, db: AsyncSession = Depends(database.get_db)):
     dummy_otp = "1234"
-    user = db.query(models.User).filter(models.User.phone_number == verification_data.phone_number).first()
+    phone_number = verification_data.phone_number
+    result = await db.execute(lambda_stmt(lambda: select(models.User).where(models.User.phone_number == phone_number)))
+    user = result.scalar_one_or_none()
     
     if not user or verification_data.otp_code != dummy_otp:
         raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Invalid phone number or OTP code.")
     
-    access_token = create_access_token(data={"user_id": user.id})
+    access_token = create_access_token(user.id)
     return {"access_token": access_token, "token_type": "bearer"}
 
 @app.get("/users/me", response_model=schemas.UserResponse)
-def read_users_me(current_user: models.User = Depends(get_current_user)):
+async def read_users_me(current_user: schemas.UserResponse = Depends(get_current_user)):
     return current_user
 
 @app.get("/products", response_model=List[schemas.ProductResponse])
-def get_products(db: Session = Depends(database.get_db)):
-    products = db.query(models.Product).all()
-    if not products:
-        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="No products found.")
-    return products
+async def get_products(
+    cursor: int = 0,
+    limit: int = Query(PRODUCTS_PAGE_SIZE, ge=1, le=PRODUCTS_MAX_PAGE_SIZE),
+    db: AsyncSession = Depends(database.get_db)
+):
+    # Keyset pagination: الصفحة التالية تبدأ بعد آخر id في الصفحة الحالية (?cursor=<last_id>)،
+    # والترويسة X-Next-Cursor تحمل قيمتها عندما تكون الصفحة ممتلئة (قد تتبعها صفحات أخرى)
+    cached = products_cache.get((cursor, limit))
+    if cached is None:
+        result = await db.execute(
+            select(models.Product)
+            .where(models.Product.id > cursor)
+            .order_by(models.Product.id)
+            .limit(limit)
+        )
+        products = result.scalars().all()
+        if not products and cursor == 0:
+            raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="No products found.")
+        body = orjson.dumps([schemas.ProductResponse.model_validate(p).model_dump() for p in products])
+        next_cursor = products[-1].id if len(products) == limit else None
+        cached = products_cache[(cursor, limit)] = (body, next_cursor)
+    body, next_cursor = cached
+    headers = {"X-Next-Cursor": str(next_cursor)} if next_cursor is not None else None
+    return Response(content=body, media_type="application/json", headers=headers)
 
 @app.post("/sessions/start", status_code=status.HTTP_201_CREATED, response_model=schemas.SessionResponse)
-def start_shopping_session(session_data: schemas.SessionCreate, db: Session = Depends(database.get_db)):
-    user = db.query(models.User).filter(models.User.id == session_data.user_id).first()
+async def start_shopping_session(session_data: schemas.SessionCreate, db: AsyncSession = Depends(database.get_db)):
+    user = await db.get(models.User, session_data.user_id)
     if not user:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="User not found.")
     
-    active_session = db.query(models.Shopping_Session).filter(
-        models.Shopping_Session.user_id == session_data.user_id,
+    user_id = session_data.user_id
+    result = await db.execute(lambda_stmt(lambda: select(models.Shopping_Session).where(
+        models.Shopping_Session.user_id == user_id,
         models.Shopping_Session.status == 'active'
-    ).first()
+    )))
+    active_session = result.scalars().first()
     if active_session:
         raise HTTPException(status_code=status.HTTP_409_CONFLICT, detail="User already has an active session.")
         
     new_session = models.Shopping_Session(user_id=session_data.user_id)
     db.add(new_session)
-    db.commit()
-    db.refresh(new_session)
+    await db.commit()
+    await db.refresh(new_session)
     return new_session
 
 @app.post("/sessions/{session_id}/cart/items", response_model=schemas.CartResponse)
-async def add_item_to_cart(session_id: int, item: schemas.CartItemCreate, db: Session = Depends(database.get_db)):
-    session = db.query(models.Shopping_Session).filter(models.Shopping_Session.id == session_id, models.Shopping_Session.status == 'active').first()
-    if not session:
-        raise HTTPException(status_code=404, detail=f"Active session {session_id} not found")
-    
-    product = db.query(models.Product).filter(models.Product.id == item.product_id).first()
-    if not product:
+async def add_item_to_cart(session_id: int, item: schemas.CartItemCreate, db: AsyncSession = Depends(database.get_db)):
+    # الجلسة والمنتج في استعلام واحد
+    product_id = item.product_id
+    result = await db.execute(lambda_stmt(
+        lambda: select(models.Shopping_Session.id, models.Product.id, models.Product.price)
+        .join(models.Product, models.Product.id == product_id)
+        .where(models.Shopping_Session.id == session_id, models.Shopping_Session.status == 'active')
+    ))
+    row = result.first()
+    if row is None:
+        session = await db.get(models.Shopping_Session, session_id)
+        if not session or session.status != 'active':
+            raise HTTPException(status_code=404, detail=f"Active session {session_id} not found")
         raise HTTPException(status_code=404, detail=f"Product {item.product_id} not found")
+    _, product_id, price = row
 
-    cart_item = db.query(models.Cart_Item).filter(models.Cart_Item.session_id == session_id, models.Cart_Item.product_id == item.product_id).first()
-    if cart_item:
-        cart_item.quantity += item.quantity
-    else:
-        new_cart_item = models.Cart_Item(session_id=session_id, product_id=item.product_id, quantity=item.quantity, price_at_pickup=product.price)
-        db.add(new_cart_item)
-    
-    db.commit()
-
-    cart_items_db = db.query(models.Cart_Item, models.Product.name).join(models.Product).filter(models.Cart_Item.session_id == session_id).all()
-    response_items = [schemas.CartItemResponse(name=name, **ci.__dict__) for ci, name in cart_items_db]
-    current_total = sum(i.quantity * i.price for i in response_items)
-    updated_cart = schemas.CartResponse(session_id=session_id, items=response_items, current_total=round(current_total, 2))
+    # INSERT ... ON CONFLICT يدمج "موجود؟ حدّث : أضف" في عبارة واحدة بدون سباق بين الطلبات
+    stmt = insert(models.Cart_Item).values(session_id=session_id, product_id=product_id, quantity=item.quantity, price_at_pickup=price)
+    stmt = stmt.on_conflict_do_update(
+        index_elements=[models.Cart_Item.session_id, models.Cart_Item.product_id],
+        set_={"quantity": models.Cart_Item.quantity + stmt.excluded.quantity},
+    )
+    await db.execute(stmt)
+    await db.commit()
+
+    # نقرأ السلة بعد الـ commit حتى تشمل ما أضافته الطلبات المتزامنة الأخرى
+    result = await db.execute(lambda_stmt(
+        lambda: select(models.Cart_Item)
+        .where(models.Cart_Item.session_id == session_id)
+        .order_by(models.Cart_Item.id)
+    ))
+    updated_cart = build_cart_response(session_id, result.scalars().all())
     
     await manager.send_cart_update(session_id, updated_cart.model_dump())
     return updated_cart
 
 @app.delete("/sessions/{session_id}/cart/items/{product_id}", response_model=schemas.CartResponse)
-async def remove_item_from_cart(session_id: int, product_id: int, db: Session = Depends(database.get_db)):
-    cart_item = db.query(models.Cart_Item).filter(models.Cart_Item.session_id == session_id, models.Cart_Item.product_id == product_id).first()
-    if not cart_item:
-        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Item not in cart.")
-    
-    if cart_item.quantity > 1:
-        cart_item.quantity -= 1
-    else:
-        db.delete(cart_item)
+async def remove_item_from_cart(session_id: int, product_id: int, db: AsyncSession = Depends(database.get_db)):
+    # الإنقاص يتم داخل قاعدة البيانات حتى لا تضيع التعديلات بين الطلبات المتزامنة
+    result = await db.execute(
+        update(models.Cart_Item)
+        .where(models.Cart_Item.session_id == session_id, models.Cart_Item.product_id == product_id, models.Cart_Item.quantity > 1)
+        .values(quantity=models.Cart_Item.quantity - 1)
+        .returning(models.Cart_Item.id)
+    )
+    if result.first() is None:
+        result = await db.execute(
+            delete(models.Cart_Item)
+            .where(models.Cart_Item.session_id == session_id, models.Cart_Item.product_id == product_id, models.Cart_Item.quantity <= 1)
+            .returning(models.Cart_Item.id)
+        )
+        if result.first() is None:
+            raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Item not in cart.")
     
-    db.commit()
+    await db.commit()
 
-    cart_items_db = db.query(models.Cart_Item, models.Product.name).join(models.Product).filter(models.Cart_Item.session_id == session_id).all()
-    response_items = [schemas.CartItemResponse(name=name, **ci.__dict__) for ci, name in cart_items_db]
-    current_total = sum(i.quantity * i.price for i in response_items)
-    updated_cart = schemas.CartResponse(session_id=session_id, items=response_items, current_total=round(current_total, 2))
+    result = await db.execute(lambda_stmt(
+        lambda: select(models.Cart_Item)
+        .where(models.Cart_Item.session_id == session_id)
+        .order_by(models.Cart_Item.id)
+    ))
+    updated_cart = build_cart_response(session_id, result.scalars().all())
 
     await manager.send_cart_update(session_id, updated_cart.model_dump())
     return updated_cart
 
 @app.post("/sessions/{session_id}/checkout", response_model=schemas.ReceiptResponse)
-def checkout(session_id: int, db: Session = Depends(database.get_db)):
-    session = db.query(models.Shopping_Session).filter(models.Shopping_Session.id == session_id, models.Shopping_Session.status == 'active').first()
-    if not session:
+async def checkout(session_id: int, db: AsyncSession = Depends(database.get_db)):
+    session = await db.get(models.Shopping_Session, session_id)
+    if not session or session.status != 'active':
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Active session not found.")
     
-    cart_items = db.query(models.Cart_Item).filter(models.Cart_Item.session_id == session_id).all()
+    result = await db.execute(lambda_stmt(
+        lambda: select(models.Cart_Item)
+        .options(joinedload(models.Cart_Item.product))
+        .where(models.Cart_Item.session_id == session_id)
+    ))
+    cart_items = result.scalars().all()
     if not cart_items:
         raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Cart is empty.")
     
     total_amount = round(sum(item.quantity * float(item.price_at_pickup) for item in cart_items), 2)
     
-    # دفع فعلي باستخدام Stripe
+    user = await db.get(models.User, session.user_id)
+
+    # دفع فعلي باستخدام Stripe (مكتبة متزامنة، لذا تُنفَّذ في الـ threadpool)
     try:
-        intent = stripe.PaymentIntent.create(
+        intent = await run_in_threadpool(
+            stripe.PaymentIntent.create,
             amount=int(total_amount * 100),
             currency="usd",
-            payment_method=session.user.payment_token,
+            payment_method=user.payment_token,
             confirm=True,
         )
         transaction_id = intent.id
     except stripe.error.CardError as e:
         raise HTTPException(status_code=400, detail=f"Payment failed: {e.user_message}")
 
-    new_receipt = models.Receipt(session_id=session_id, total_amount=total_amount, transaction_id=transaction_id)
-    db.add(new_receipt)
+    result = await db.execute(
+        insert(models.Receipt)
+        .values(session_id=session_id, total_amount=total_amount, transaction_id=transaction_id)
+        .returning(models.Receipt.id, models.Receipt.created_at)
+    )
+    receipt_id, created_at = result.one()
 
-    for item in cart_items:
-        product = db.query(models.Product).filter(models.Product.id == item.product_id).first()
-        subtotal = item.quantity * float(item.price_at_pickup)
-        db.add(models.Receipt_Details(receipt_id=new_receipt.id, product_name=product.name, quantity=item.quantity, price=item.price_at_pickup, subtotal=subtotal))
+    # إدخال جماعي واحد (executemany) بدلاً من كائن ORM لكل عنصر
+    details = [
+        {"receipt_id": receipt_id, "product_name": item.product.name, "quantity": item.quantity, "price": item.price_at_pickup, "subtotal": item.quantity * float(item.price_at_pickup)}
+        for item in cart_items
+    ]
+    await db.execute(insert(models.Receipt_Details), details)
 
     session.status = 'completed'
-    db.commit()
-    db.refresh(new_receipt)
-
-    return new_receipt
+    await db.commit()
+
+    return schemas.ReceiptResponse(
+        receipt_id=receipt_id,
+        session_id=session_id,
+        total_amount=total_amount,
+        transaction_id=transaction_id,
+        created_at=created_at,
+        items=[schemas.ReceiptDetailResponse(**detail) for detail in details],
+    )
 
 
 
 
 @app.get("/sessions/active", response_model=schemas.SessionResponse)
-def get_active_session(db: Session = Depends(database.get_db), current_user: models.User = Depends(get_current_user)):
-    active_session = db.query(models.Shopping_Session).filter(
-        models.Shopping_Session.user_id == current_user.id,
+async def get_active_session(db: AsyncSession = Depends(database.get_db), current_user: schemas.UserResponse = Depends(get_current_user)):
+    user_id = current_user.id
+    result = await db.execute(lambda_stmt(lambda: select(models.Shopping_Session).where(
+        models.Shopping_Session.user_id == user_id,
         models.Shopping_Session.status == 'active'
-    ).first()
+    )))
+    active_session = result.scalars().first()
     
     if not active_session:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="No active session found for this user.")
@@ -271,15 +560,18 @@ def get_active_session(db: Session = Depends(database.get_db), current_user: mod
       
 
 @app.patch("/users/me/payment-token", response_model=schemas.UserResponse)
-def update_payment_token(
+async def update_payment_token(
     request: schemas.PaymentTokenUpdate,
-    db: Session = Depends(database.get_db),
-    current_user: models.User = Depends(get_current_user)
+    db: AsyncSession = Depends(database.get_db),
+    current_user: schemas.UserResponse = Depends(get_current_user)
 ):
-    current_user.payment_token = request.payment_token
-    db.commit()
-    db.refresh(current_user)
-    return current_user      
+    # current_user نسخة مخزّنة وليست كائن ORM، فنعدّل السجل عبر هذه الجلسة
+    user = await db.get(models.User, current_user.id)
+    user.payment_token = request.payment_token
+    await db.commit()
+    await db.refresh(user)
+    user_cache.pop(user.id, None)
+    return user      
 # In lib/main.py
 
 
@@ -287,15 +579,18 @@ def update_payment_token(
 
 
 @app.post("/alerts/tailgating", status_code=status.HTTP_201_CREATED)
-def report_tailgating_alert(db: Session = Depends(database.get_db)):
+async def report_tailgating_alert(db: AsyncSession = Depends(database.get_db)):
     # 1. ابحث عن آخر جلسة تم إنشاؤها في آخر 5 ثوانٍ
     # هذا يفترض أن مسح الـ QR وإنشاء الجلسة يحدث قبل التسلل بلحظات
     time_window = datetime.now() - timedelta(seconds=5)
     
-    recent_session = db.query(models.Shopping_Session)\
-        .filter(models.Shopping_Session.entry_time >= time_window)\
-        .order_by(models.Shopping_Session.entry_time.desc())\
-        .first()
+    result = await db.execute(
+        select(models.Shopping_Session)
+        .where(models.Shopping_Session.entry_time >= time_window)
+        .order_by(models.Shopping_Session.entry_time.desc())
+        .limit(1)
+    )
+    recent_session = result.scalar_one_or_none()
 
     session_id_to_log = None
     if recent_session:
@@ -307,14 +602,9 @@ def report_tailgating_alert(db: Session = Depends(database.get_db)):
         details=f"More than one person detected on entry. Associated with recent session: {session_id_to_log}"
     )
     db.add(new_alert)
-    db.commit()
+    await db.commit()
     
     # 3. محاكاة لإبلاغ الحارس الأمني
-    print("="*50)
-    print(f"!!! SECURITY ALERT: TAILGATING DETECTED !!!")
-    if session_id_to_log:
-        print(f"!!! Possibly associated with Session ID: {session_id_to_log} !!!")
-    print(f"!!! Time: {datetime.now()} !!!")
-    print("="*50)
+    logger.warning("!!! SECURITY ALERT: TAILGATING DETECTED !!! Possibly associated with Session ID: %s", session_id_to_log)
 
     return {"message": "Alert logged successfully."}
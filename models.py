@@ -1,6 +1,6 @@
 # file: models.py
 
-from sqlalchemy import Column, Integer, String, TIMESTAMP, ForeignKey, DECIMAL
+from sqlalchemy import Column, Integer, String, TIMESTAMP, ForeignKey, DECIMAL, Index
 from sqlalchemy.orm import relationship
 from sqlalchemy.sql.expression import text
 from database import Base
@@ -29,14 +29,21 @@ class Shopping_Session(Base):
     exit_time = Column(TIMESTAMP(timezone=True), nullable=True)
     status = Column(String, nullable=False, default='active')
 
+    cart_items = relationship("Cart_Item", cascade="all, delete-orphan", order_by="Cart_Item.id")
+
 class Cart_Item(Base):
     __tablename__ = "cart_items"
+    __table_args__ = (
+        Index("ix_cart_item_session_product", "session_id", "product_id", unique=True),
+    )
     id = Column(Integer, primary_key=True, nullable=False)
     session_id = Column(Integer, ForeignKey("shopping_sessions.id", ondelete="CASCADE"), nullable=False)
     product_id = Column(Integer, ForeignKey("products.id", ondelete="CASCADE"), nullable=False)
     quantity = Column(Integer, nullable=False, default=1)
     price_at_pickup = Column(DECIMAL(10, 2), nullable=False)
 
+    product = relationship("Product", lazy="joined")
+
 class Receipt(Base):
     __tablename__ = "receipts"
     id = Column(Integer, primary_key=True, nullable=False)